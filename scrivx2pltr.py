@@ -5,15 +5,125 @@
 #
 import argparse
 import base64
+import concurrent.futures
+import hashlib
 import json
+import os
 import os.path
+import re
+import shutil
 import sys
+import time
 import xml.etree.ElementTree as ET
 
 #from striprtf import rtf_to_text
 
 ### ###########################################################################
 
+class ImageCache:
+    """ On-disk cache of base64 encoded images, so that we don't have to read
+        and encode the (rarely changing) images again on every run.
+        There is one file per image; its mtime tells when it was last used.
+        Files are only ever replaced atomically, so that several conversions
+        can share the same cache. """
+
+    # temporary files older than this were left behind by a crashed writer
+    orphanAge = 3600
+
+    def __init__(self, directory, maxSize):
+        self.directory = directory
+        self.maxSize = maxSize
+        self.written = False
+
+
+    def __cacheFile(self, file, imgtype):
+        """ Name of the cache file for an image. Returns '' if we can't stat it. """
+
+        try:
+            st = os.stat(file)
+        except OSError:
+            return ''
+
+        key = os.path.abspath(file) + '|' + str(st.st_mtime_ns) + '|' + str(st.st_size) + '|' + imgtype
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.b64')
+
+
+    def lookup(self, file, imgtype):
+        """ Returns the name of the file holding the encoded image or None if
+            it isn't in the cache. The file isn't read here, it is copied
+            straight into the Plottr file later. """
+
+        cachefile = self.__cacheFile(file, imgtype)
+        if len(cachefile) == 0:
+            return None
+
+        try:
+            os.utime(cachefile) # mark as recently used
+        except OSError: # not cached, or just evicted by someone else
+            return None
+
+        return cachefile
+
+
+    def put(self, file, imgtype, ibstring):
+
+        cachefile = self.__cacheFile(file, imgtype)
+        if len(cachefile) == 0 or len(ibstring) > self.maxSize:
+            return
+
+        try:
+            os.makedirs(self.directory, exist_ok = True)
+            tmpfile = cachefile + '.' + str(os.getpid()) + '.tmp'
+            with open(tmpfile, 'w', encoding = 'ascii') as fs:
+                fs.write(ibstring)
+            os.replace(tmpfile, cachefile)
+        except OSError:
+            print("WARNING: Could not write image cache " + cachefile)
+            return
+
+        self.written = True
+
+
+    def flush(self):
+        """ Remove the least recently used images until we're below maxSize.
+            Call once after all images have been added. """
+
+        if not self.written:
+            return
+
+        entries = []
+        total = 0
+        orphaned = time.time() - self.orphanAge
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                try:
+                    st = entry.stat()
+                except OSError: # removed in the meantime
+                    continue
+                if entry.name.endswith('.b64'):
+                    entries.append((st.st_mtime_ns, st.st_size, entry.path))
+                    total = total + st.st_size
+                elif entry.name.endswith('.tmp'):
+                    if st.st_mtime < orphaned:
+                        try:
+                            os.remove(entry.path)
+                        except OSError:
+                            total = total + st.st_size
+                    else: # probably still being written by someone else
+                        total = total + st.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.maxSize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass # someone else was faster
+            total = total - size
+
+### ###########################################################################
+
 class PlottrContent:
     """ Simple class to hold the content that goes into the Plottr file """
 
@@ -23,6 +133,7 @@ class PlottrContent:
     def __init__(self):
         self.cards = []
         self.cardId = 1
+        self.binderIds = {} # card id -> UUID of the Scrivener binder item
         self.positionWithinLine = 0
         self.positionInBeat = 0
 
@@ -34,6 +145,8 @@ class PlottrContent:
 
         self.images = {}
         self.num_images = 0
+        self.imageCache = None
+        self.cachedImages = {} # image id -> file in the image cache
 
         self.characters = []
         self.characterId = 1
@@ -47,6 +160,7 @@ class PlottrContent:
         self.lineId = 1
         self.lineId_max = 1
         self.position_for_line = 0
+        self.finalised = False
 
         self.booktitle = ''
         self.premise = ''
@@ -55,11 +169,18 @@ class PlottrContent:
         self.keywords = {}
         self.tagId = 0
 
+        self.sceneAttributes = []
+
+        # bytes we know will be in the output but didn't read (--estimate)
+        self.unreadBytes = 0
+        self.imageBytes = 0
+
         self.config = {}
         self.config['useLabelColorsForSceneCards'] = False
         self.config['labelsAreCharacters'] = False
         self.config['keywordsAreCharacters'] = False
         self.config['keywordsAreTags'] = False
+        self.config['estimateOnly'] = False
 
 
     def __getColor(self, color):
@@ -75,12 +196,6 @@ class PlottrContent:
         imgid = -1
 
         if os.path.isfile(file):
-            with open(file, 'rb') as fs:
-                imgdata = fs.read() 
-
-            ibdata = base64.b64encode(imgdata)
-            ibstring = ibdata.decode('utf-8')
-
             filename = os.path.basename(file)
             x = filename.split('.')
             ext = x[-1]
@@ -93,6 +208,26 @@ class PlottrContent:
                 imgtype = 'gif'
             else: # what other image types could there be?
                 imgtype = 'unknown'
+
+            if self.config['estimateOnly']:
+                # don't read the image, only account for its base64 size
+                ibstring = ''
+                self.imageBytes = self.imageBytes + 4 * ((os.path.getsize(file) + 2) // 3)
+            else:
+                cachefile = None
+                if self.imageCache is not None:
+                    cachefile = self.imageCache.lookup(file, imgtype)
+
+                if cachefile is not None:
+                    # write() copies the encoded image from the cache
+                    ibstring = ''
+                    self.cachedImages[str(self.num_images)] = cachefile
+                else:
+                    ibstring = self.__encodeImage(file)
+
+                    if self.imageCache is not None:
+                        self.imageCache.put(file, imgtype, ibstring)
+
             data = 'data:image/' + imgtype + ';base64,' + ibstring
 
             # most filenames are actually just "card-image.jpg"
@@ -109,6 +244,44 @@ class PlottrContent:
         return imgid
 
 
+    def __encodeImage(self, file):
+
+        with open(file, 'rb') as fs:
+            imgdata = fs.read() 
+
+        ibdata = base64.b64encode(imgdata)
+        return ibdata.decode('utf-8')
+
+
+    def __writeImages(self, fs):
+        """ Write the images, copying those from the image cache directly into
+            the file instead of reading them into memory first. """
+
+        fs.write('{')
+        for n, imgid in enumerate(self.images):
+            if n > 0:
+                fs.write(', ')
+            fs.write(json.dumps(imgid) + ': ')
+
+            image = self.images[imgid]
+            cachefile = self.cachedImages.get(imgid)
+            if cachefile is None:
+                fs.write(json.dumps(image))
+                continue
+
+            # 'data' is the last entry, so cut off its closing quote and
+            # the brace and put the encoded image in between
+            head = json.dumps(image)
+            fs.write(head[:-2])
+            try:
+                with open(cachefile, 'r', encoding = 'ascii') as cs:
+                    shutil.copyfileobj(cs, fs)
+            except OSError: # evicted by someone else in the meantime
+                fs.write(self.__encodeImage(image['path']))
+            fs.write('"}')
+        fs.write('}')
+
+
     def __addBeat(self):
         self.beats.append({ 'id': self.beatId, 'bookId': 1, 'position': self.positionOfBeat, 'title': 'auto', 'time': 0, 'templates': [], 'autoOutlineSort': True, 'fromTemplateId' : None })
 
@@ -140,6 +313,20 @@ class PlottrContent:
         self.config['keywordsAreTags'] = keywordsAreTags
 
 
+    def useImageCache(self, imageCache):
+        self.imageCache = imageCache
+
+
+    def estimateOnly(self, estimateOnly):
+        self.config['estimateOnly'] = estimateOnly
+
+
+    def addUnreadBytes(self, size):
+        """ Account for text that would have gone into the file (--estimate). """
+
+        self.unreadBytes = self.unreadBytes + size
+
+
     def addLabel(self, id, title, color):
         self.labels[id] = { 'title': title, 'color': color }
 
@@ -193,7 +380,13 @@ class PlottrContent:
         return tags
 
 
-    def addCard(self, title, description, label = '', keywords = []):
+    def addSceneAttribute(self, name, type = 'text'):
+        """ Add a custom attribute that every scene card can have. """
+
+        self.sceneAttributes.append({ 'name': name, 'type': type })
+
+
+    def addCard(self, title, description, label = '', keywords = [], attributes = {}, uuid = ''):
 
         text = [ { 'text': description } ]
         description = [ { 'type': 'paragraph', 'children': text } ]
@@ -214,7 +407,12 @@ class PlottrContent:
         if self.config['keywordsAreTags'] and len(keywords) > 0:
             card['tags'] = self.__matchKeywordsToTags(keywords)
 
+        # Plottr keeps the values of custom attributes directly in the card
+        for name in attributes:
+            card[name] = attributes[name]
+
         self.cards.append(card)
+        self.binderIds[self.cardId] = uuid
         self.cardId = self.cardId + 1
 
         # update beats
@@ -322,13 +520,112 @@ class PlottrContent:
 
     def __finalisePlotlines(self):
 
+        if self.finalised:
+            return
+        self.finalised = True
+
         self.closePlotline(0) # explicitly close the default plotline
 
         # required special plotline
         self.lines.append({ 'id': self.lineId_max + 1, 'bookId': 'series', 'color': '#6cace4', 'title': 'Main Plot', 'position': 0, 'characterId': None, 'expanded': None, 'fromTemplateId': None })
 
 
-    def write(self, filename):
+    def numCards(self):
+        return len(self.cards)
+
+
+    def shard(self, first, last, title, unreferencedImages = False):
+        """ Create a new PlottrContent with only the cards first .. last
+            (1-based positions). It gets its own beats and plotlines and only
+            the images of the characters and places its cards refer to, plus
+            those nobody refers to if unreferencedImages is set. """
+
+        self.__finalisePlotlines()
+
+        sh = PlottrContent()
+        sh.booktitle = title
+        sh.premise = self.premise
+        sh.labels = self.labels
+        sh.keywords = self.keywords
+        sh.tagId = self.tagId
+        sh.sceneAttributes = self.sceneAttributes
+        sh.config = dict(self.config)
+
+        # plotlines in use, in their original order (the last one is the
+        # special series plotline, which every file gets anyway)
+        cards = self.cards[first - 1:last]
+        used = set([ card['lineId'] for card in cards ])
+        lineIds = {}
+        sh.lines = []
+        for l in self.lines[:-1]:
+            if l['id'] in used:
+                lineIds[l['id']] = len(sh.lines) + 1
+                line = dict(l)
+                line['id'] = len(sh.lines) + 1
+                line['position'] = len(sh.lines)
+                sh.lines.append(line)
+        sh.lineId_max = len(sh.lines)
+        sh.lines.append({ 'id': sh.lineId_max + 1, 'bookId': 'series', 'color': '#6cace4', 'title': 'Main Plot', 'position': 0, 'characterId': None, 'expanded': None, 'fromTemplateId': None })
+        sh.finalised = True
+
+        # each card has a beat of its own
+        characterIds = set()
+        placeIds = set()
+        for card in cards:
+            c = dict(card)
+            c['id'] = sh.cardId
+            c['lineId'] = lineIds[card['lineId']]
+            c['beatId'] = sh.beatId
+            sh.cards.append(c)
+            sh.binderIds[sh.cardId] = self.binderIds[card['id']]
+            sh.cardId = sh.cardId + 1
+            sh.__addBeat()
+
+            characterIds.update(card['characters'])
+            placeIds.update(card['places'])
+
+        # characters and places are always there, but not all of their images
+        referencedCharacters = set()
+        referencedPlaces = set()
+        for card in self.cards:
+            referencedCharacters.update(card['characters'])
+            referencedPlaces.update(card['places'])
+
+        sh.num_images = self.num_images
+        for ch in self.characters:
+            ch = dict(ch)
+            if ch['imageId'] != '':
+                if ch['id'] in characterIds or (unreferencedImages and ch['id'] not in referencedCharacters):
+                    sh.__copyImage(self, ch['imageId'])
+                else:
+                    ch['imageId'] = ''
+            sh.characters.append(ch)
+        for pl in self.places:
+            pl = dict(pl)
+            if pl['imageId'] != '':
+                if pl['id'] in placeIds or (unreferencedImages and pl['id'] not in referencedPlaces):
+                    sh.__copyImage(self, pl['imageId'])
+                else:
+                    pl['imageId'] = ''
+            sh.places.append(pl)
+        sh.characterId = self.characterId
+        sh.placeId = self.placeId
+
+        return sh
+
+
+    def __copyImage(self, other, imgid):
+
+        self.images[imgid] = other.images[imgid]
+        if imgid in other.cachedImages:
+            self.cachedImages[imgid] = other.cachedImages[imgid]
+
+
+    def binderIdsOfCards(self):
+        return [ self.binderIds[card['id']] for card in self.cards ]
+
+
+    def __serialise(self, filename):
 
         self.__finalisePlotlines()
 
@@ -338,7 +635,7 @@ class PlottrContent:
         series = { 'name': self.booktitle, 'premise': self.premise, 'genre': '', 'theme': '', 'templates': [] }
         books = { '1': { 'id': 1, 'title': self.booktitle, 'premise': self.premise, 'genre': '', 'theme': '', 'templates': [], 'timelineTemplates': [], 'imageId': None }, 'allIds': [1] }
         categories = { 'characters': [ { 'id': 1, 'name': 'Main', 'position': 0 }, { 'id': 2, 'name': 'Supporting', 'position': 1 }, { 'id': 3, 'name': 'Other', 'position': 2 } ], 'places': [], 'notes': [], 'tags': [] }
-        customAttributes = { 'characters': [], 'places': [], 'scenes': [], 'lines': [] }
+        customAttributes = { 'characters': [], 'places': [], 'scenes': self.sceneAttributes, 'lines': [] }
         notes = []
 
         tags = []
@@ -360,17 +657,50 @@ class PlottrContent:
         nstring = '"notes":' + json.dumps(notes) + ','
         pstring = '"places":' + json.dumps(self.places) + ','
         tstring = '"tags":' + json.dumps(tags) + ','
-        istring = '"images":' + json.dumps(self.images)
 
+        # everything but the images, which can be huge
+        return '{' + fstring + ustring + sstring + bstring + btstring + cdstring + cstring + chstring + custring + lstring + nstring + pstring + tstring + '"images":'
+
+
+    def write(self, filename):
+
+        content = self.__serialise(filename)
         with open(filename, 'w', encoding = 'utf-8') as fs:
-            fs.write('{' + fstring + ustring + sstring + bstring + btstring + cdstring + cstring + chstring + custring + lstring + nstring + pstring + tstring + istring + '}')
+            fs.write(content)
+            self.__writeImages(fs)
+            fs.write('}')
+
+
+    def estimate(self, filename):
+        """ Report what write() would produce, without writing anything. """
+
+        content = self.__serialise(filename) + json.dumps(self.images) + '}'
+        size = len(content.encode('utf-8')) + self.unreadBytes + self.imageBytes
+        # worst case: all of the text is non-ASCII, e.g. 2 bytes UTF-8 -> \uXXXX
+        maxsize = size + 2 * self.unreadBytes
+
+        # the last 'lines' entry is the special series plotline
+        print('Scene cards: {:d}'.format(len(self.cards)))
+        print('Plotlines:   {:d}'.format(len(self.lines) - 1))
+        print('Characters:  {:d}'.format(len(self.characters)))
+        print('Places:      {:d}'.format(len(self.places)))
+        print('Images:      {:d} ({:,d} bytes after base64)'.format(len(self.images), self.imageBytes))
+        print('Output size: at least {:,d} bytes, at most {:,d} bytes ({})'.format(size, maxsize, filename))
 
 ### ###########################################################################
 
 def read_synopsis(scrivpackage, uuid):
 
+    global args, plottr
+
     syn = os.path.join(scrivpackage, 'Files', 'Data', uuid, 'synopsis.txt')
-    if os.path.isfile(syn):
+    if args.estimate:
+        # only note the size; since json.dumps() writes non-ASCII
+        # characters as \uXXXX, the text may end up as much as 3 times as big
+        if os.path.isfile(syn):
+            plottr.addUnreadBytes(os.path.getsize(syn))
+        s = ''
+    elif os.path.isfile(syn):
         with open(syn, 'r', encoding = 'utf-8') as fs:
             s = fs.read()
     else: # doesn't have a synopsis
@@ -391,6 +721,182 @@ def read_notes(scrivpackage, uuid):
 
     return n
 
+# RTF groups whose content is never part of the visible text
+rtf_destinations = { b'fonttbl', b'colortbl', b'stylesheet', b'listtable', b'listoverridetable', b'info', b'pict', b'object', b'header', b'footer', b'footnote', b'fldinst', b'themedata', b'xmlnstbl', b'rsidtbl', b'generator' }
+# RTF control words that separate words
+rtf_separators = { b'par', b'line', b'tab', b'cell', b'row', b'sect', b'page', b'column' }
+
+rtf_token = re.compile(rb"\\([a-zA-Z]+)(-?\d+)? ?|\\'([0-9a-fA-F]{2})|\\(.)|([{}])|([^\\{}]+)", re.DOTALL)
+rtf_word = re.compile(rb'\S+')
+
+def count_words_rtf(rtffile):
+    """ Count the words in an RTF file without decoding the whole text.
+        The file is read in chunks and only the word count is kept. """
+
+    words = 0
+    in_word = False
+    skip = False   # inside a group we're not interested in
+    uc = 1         # number of fallback characters following a \\uN
+    pending = 0    # fallback characters still to skip
+    stack = []
+    carry = b''
+
+    with open(rtffile, 'rb') as fs:
+        while True:
+            chunk = fs.read(65536)
+            buf = carry + chunk
+            if len(chunk) > 0:
+                # hold back everything from the last backslash (or run of
+                # backslashes) since the control word may not be complete yet
+                pos = buf.rfind(b'\\')
+                while pos > 0 and buf[pos - 1:pos] == b'\\':
+                    pos = pos - 1
+                if pos < 0 or len(buf) - pos > 64:
+                    # no control word at the very end, nothing to hold back
+                    pos = len(buf)
+                carry = buf[pos:]
+                buf = buf[:pos]
+
+            for m in rtf_token.finditer(buf):
+                word, param, hexchar, symbol, brace, text = m.groups()
+
+                if brace is not None:
+                    if brace == b'{':
+                        stack.append((skip, uc))
+                    elif len(stack) > 0:
+                        skip, uc = stack.pop()
+                    pending = 0
+
+                elif word is not None:
+                    if word in rtf_destinations:
+                        skip = True
+                    elif word == b'uc':
+                        uc = int(param) if param is not None else 1
+                    elif skip:
+                        pass
+                    elif word == b'u' and param is not None:
+                        code = int(param)
+                        if code < 0:
+                            code = code + 65536
+                        if chr(code).isspace():
+                            in_word = False
+                        elif not in_word:
+                            words = words + 1
+                            in_word = True
+                        pending = uc
+                    elif word in rtf_separators:
+                        in_word = False
+
+                elif symbol is not None:
+                    if symbol == b'*':
+                        skip = True
+                    elif skip:
+                        pass
+                    elif symbol in (b'\n', b'\r'):
+                        # Scrivener writes paragraph breaks as \<newline>
+                        in_word = False
+                    elif symbol in (b'\\', b'{', b'}', b'~', b'_'):
+                        if not in_word:
+                            words = words + 1
+                            in_word = True
+
+                elif hexchar is not None:
+                    if skip:
+                        pass
+                    elif pending > 0:
+                        pending = pending - 1
+                    elif int(hexchar, 16) in (0x09, 0x0a, 0x0d, 0x20):
+                        in_word = False
+                    elif not in_word:
+                        words = words + 1
+                        in_word = True
+
+                elif not skip:
+                    # line breaks in the RTF source are not part of the text
+                    text = text.replace(b'\r', b'').replace(b'\n', b'')
+                    if pending > 0:
+                        n = min(pending, len(text))
+                        text = text[n:]
+                        pending = pending - n
+                    if len(text) == 0:
+                        continue
+                    for w in rtf_word.finditer(text):
+                        if w.start() > 0 or not in_word:
+                            words = words + 1
+                    in_word = not text[-1:].isspace()
+
+            if len(chunk) == 0:
+                break
+
+    return words
+
+def count_words_of_file(rtffile):
+
+    if os.path.isfile(rtffile):
+        return count_words_rtf(rtffile)
+    else: # scene without any text
+        return 0
+
+def read_wordcounts(scrivfile, uuids):
+    """ Count the words of all the given scenes, using a pool of workers.
+        Counts are cached per project and only recounted when the
+        content.rtf changed. """
+
+    global args
+
+    cache = {}
+    cachefile = ''
+    if len(args.cacheDir) > 0:
+        project = hashlib.sha256(os.path.abspath(scrivfile).encode('utf-8')).hexdigest()[:16]
+        cachefile = os.path.join(args.cacheDir, 'wordcounts-' + project + '.json')
+        if os.path.isfile(cachefile):
+            try:
+                with open(cachefile, 'r', encoding = 'utf-8') as fs:
+                    cache = json.load(fs)
+            except (OSError, ValueError):
+                cache = {} # unreadable cache - simply start over
+
+    counts = {}
+    todo = {}
+    for uuid in uuids:
+        rtffile = os.path.abspath(os.path.join(scrivfile, 'Files', 'Data', uuid, 'content.rtf'))
+        try:
+            st = os.stat(rtffile)
+            stamp = [ st.st_mtime_ns, st.st_size ]
+        except OSError:
+            stamp = None
+        c = cache.get(uuid)
+        if stamp is not None and c is not None and c['stamp'] == stamp:
+            counts[uuid] = c['words']
+        else:
+            todo[uuid] = (rtffile, stamp)
+
+    # forget about scenes that are no longer in the binder
+    stale = len(set(cache) - set(uuids)) > 0
+    cache = { uuid: cache[uuid] for uuid in uuids if uuid in cache }
+
+    if len(todo) > 0:
+        with concurrent.futures.ProcessPoolExecutor(max_workers = args.workers) as pool:
+            uuidlist = list(todo)
+            results = pool.map(count_words_of_file, [ todo[u][0] for u in uuidlist ], chunksize = 8)
+            for uuid, words in zip(uuidlist, results):
+                counts[uuid] = words
+                rtffile, stamp = todo[uuid]
+                if stamp is not None:
+                    cache[uuid] = { 'stamp': stamp, 'words': words }
+
+    if (len(todo) > 0 or stale) and len(cachefile) > 0:
+        try:
+            os.makedirs(args.cacheDir, exist_ok = True)
+            tmpfile = cachefile + '.' + str(os.getpid())
+            with open(tmpfile, 'w', encoding = 'utf-8') as fs:
+                json.dump(cache, fs)
+            os.replace(tmpfile, cachefile)
+        except OSError:
+            print("WARNING: Could not write word count cache " + cachefile)
+
+    return counts
+
 def read_bookinfo(scrivfile):
 
     global plottr
@@ -560,6 +1066,14 @@ def read_places(scrivfile, scrivp):
                     break
 
 
+def is_scene(item):
+    """ Check if a binder item will become a scene card """
+
+    global args
+
+    return item.attrib['Type'] == 'Text' or (item.attrib['Type'] == 'Folder' and args.foldersAsScenes)
+
+
 def parse_binderitem(item):
 
     global args, plottr
@@ -575,7 +1089,7 @@ def parse_binderitem(item):
             # add plotline
             state = plottr.newPlotline(plotline_title)
 
-    if item.attrib['Type'] == 'Text' or (item.attrib['Type'] == 'Folder' and args.foldersAsScenes):
+    if is_scene(item):
 
         # add this as a scene
         title = ''
@@ -592,7 +1106,11 @@ def parse_binderitem(item):
 
         s = read_synopsis(args.scrivfile, item.attrib['UUID'])
 
-        plottr.addCard(title, s, label, keywords)
+        attributes = {}
+        if args.wordCounts:
+            attributes['Word Count'] = str(wordcounts.get(item.attrib['UUID'], 0))
+
+        plottr.addCard(title, s, label, keywords, attributes, item.attrib['UUID'])
 
     # recurse for any child items / subfolders
     if item.find('Children') is not None:
@@ -602,6 +1120,41 @@ def parse_binderitem(item):
         if not args.flattenTimeline:
             plottr.closePlotline(state)
 
+def write_shards(plottrfile, shards):
+    """ Write one Plottr file per shard, concurrently, plus an index file
+        listing which binder items went into which file.
+        shards is a list of (first card, last card, title) tuples. """
+
+    global args, plottr
+
+    base, ext = os.path.splitext(plottrfile)
+    digits = len(str(len(shards)))
+
+    files = []
+    index = { 'shards': [] }
+    for n, (first, last, title) in enumerate(shards):
+        shardfile = base + '-' + str(n + 1).zfill(digits) + ext
+        sh = plottr.shard(first, last, title)
+        files.append((sh, shardfile))
+        index['shards'].append({ 'file': os.path.basename(shardfile), 'title': title, 'uuids': sh.binderIdsOfCards() })
+
+    # images of characters and places that no scene card refers to get a
+    # file of their own, without any scene cards
+    title = plottr.booktitle + ' - Characters and Places'
+    sh = plottr.shard(1, 0, title, True)
+    if len(sh.images) > 0:
+        shardfile = base + '-characters-places' + ext
+        files.append((sh, shardfile))
+        index['shards'].append({ 'file': os.path.basename(shardfile), 'title': title, 'uuids': [] })
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers = args.workers) as pool:
+        futures = [ pool.submit(sh.write, shardfile) for sh, shardfile in files ]
+        for f in futures:
+            f.result()
+
+    with open(base + '-index.json', 'w', encoding = 'utf-8') as fs:
+        json.dump(index, fs, indent = 2)
+
 def color_to_hex(scrivcolor):
     """ Scrivener stores colours as 3 float values,
         Plottr prefers 6-digit hex strings. So convert. """
@@ -653,87 +1206,161 @@ def read_keywords(scrivp):
 
 ### ###########################################################################
 
-parser = argparse.ArgumentParser(description = 'Creating a Plottr file from a Scrivener file')
-parser.add_argument('scrivfile', help = 'Scrivener file to read')
-parser.add_argument('-o', '--output', metavar = 'pltrfile', help = 'Plottr file to write')
-parser.add_argument('--foldersAsScenes', action = 'store_true', default = False, help = 'Create scene cards for folders, too')
-parser.add_argument('--flattenTimeline', action = 'store_true', default = False, help = 'Keep all scenes in one timeline')
-parser.add_argument('--useLabelColors', action = 'store_true', default = False, help = 'Use the Scrivener label colors for the scene cards')
-parser.add_argument('--labelsAreCharacters', action = 'store_true', default = False, help = 'Match Scrivener labels to characters')
-parser.add_argument('--keywordsAreCharacters', action = 'store_true', default = False, help = 'Match Scrivener keywords to characters')
-parser.add_argument('--keywordsAreTags', action = 'store_true', default = False, help = 'Treat Scrivener keywords as Plottr tags')
-parser.add_argument('--maxCharacters', type = int, default = -1, help = 'Max. number of Characters to read')
-parser.add_argument('--maxPlaces', type = int, default = -1, help = 'Max. number of Places to read')
-parser.add_argument('--charactersFolder', default = 'Characters', help = 'Name of the Characters folder, if renamed')
-parser.add_argument('--placesFolder', default = 'Places', help = 'Name of the Places folder, if renamed')
-args = parser.parse_args()
-
-# sanity check Scrivener file
-if args.scrivfile[-1] == '/':
-    args.scrivfile = args.scrivfile[:-1]
-if not os.path.isdir(args.scrivfile):
-    print("ERROR: Scrivener file " + args.scrivfile + " does not exist.")
-    exit(2)
-
-# name of the .scrivx file may differ from the .scriv
-scrivx = ''
-with os.scandir(args.scrivfile) as it:
-    for entry in it:
-        if entry.name.endswith('.scrivx'):
-            scrivx = entry.name
-            break
-if len(scrivx) == 0: # last-ditch effort ...
-    scrivx = os.path.basename(args.scrivfile) + 'x'
+def positive_int(value):
+    """ argparse type for options that need to be 1 or more """
 
-scrivxfile = os.path.join(args.scrivfile, scrivx)
-if not os.path.isfile(scrivxfile):
-    print("ERROR: This does not appear to be a Scrivener file.")
-    exit(3)
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError('must be at least 1')
 
-if args.output:
-    if os.path.isdir(args.output):
-        p = scrivx.replace('.scrivx', '.pltr')
-        plottrfile = os.path.join(args.output, p)
-    else:
-        plottrfile = args.output
-else:
-    # if not given, create from Scrivener file name
-    p = scrivx.replace('.scrivx', '.pltr')
-    plottrfile = os.path.join(os.path.dirname(args.scrivfile), p)
+    return n
 
-with open(scrivxfile, 'r', encoding = 'utf-8') as fs:
-    sx = fs.read()
+def non_negative_int(value):
+    """ argparse type for options that need to be 0 or more """
 
-scrivp = ET.fromstring(sx)
+    n = int(value)
+    if n < 0:
+        raise argparse.ArgumentTypeError('must not be negative')
 
-# final Scrivener sanity check: is it a Scrivener 3 file (XML version 2.0)?
-if scrivp.attrib['Version'] != '2.0':
-    print("ERROR: This does not appear to be a Scrivener 3 file.")
-    exit(4)
+    return n
 
-# all fine, let's go
+### ###########################################################################
 
-plottr = PlottrContent()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Creating a Plottr file from a Scrivener file')
+    parser.add_argument('scrivfile', help = 'Scrivener file to read')
+    parser.add_argument('-o', '--output', metavar = 'pltrfile', help = 'Plottr file to write')
+    parser.add_argument('--foldersAsScenes', action = 'store_true', default = False, help = 'Create scene cards for folders, too')
+    parser.add_argument('--flattenTimeline', action = 'store_true', default = False, help = 'Keep all scenes in one timeline')
+    parser.add_argument('--useLabelColors', action = 'store_true', default = False, help = 'Use the Scrivener label colors for the scene cards')
+    parser.add_argument('--labelsAreCharacters', action = 'store_true', default = False, help = 'Match Scrivener labels to characters')
+    parser.add_argument('--keywordsAreCharacters', action = 'store_true', default = False, help = 'Match Scrivener keywords to characters')
+    parser.add_argument('--keywordsAreTags', action = 'store_true', default = False, help = 'Treat Scrivener keywords as Plottr tags')
+    parser.add_argument('--maxCharacters', type = int, default = -1, help = 'Max. number of Characters to read')
+    parser.add_argument('--maxPlaces', type = int, default = -1, help = 'Max. number of Places to read')
+    parser.add_argument('--charactersFolder', default = 'Characters', help = 'Name of the Characters folder, if renamed')
+    parser.add_argument('--placesFolder', default = 'Places', help = 'Name of the Places folder, if renamed')
+    parser.add_argument('--wordCounts', action = 'store_true', default = False, help = 'Add the word count of each scene to its scene card')
+    parser.add_argument('--workers', type = positive_int, default = os.cpu_count(), help = 'Number of workers for counting words and writing shards')
+    shard = parser.add_mutually_exclusive_group()
+    shard.add_argument('--shardByFolder', action = 'store_true', default = False, help = 'Write one Plottr file per top-level folder of the Draft folder')
+    shard.add_argument('--shardSize', type = non_negative_int, default = 0, help = 'Write one Plottr file per this many scene cards')
+    parser.add_argument('--estimate', action = 'store_true', default = False, help = 'Only estimate the size of the Plottr file, do not write it')
+    parser.add_argument('--imageCacheSize', type = int, default = 0, help = 'Cache encoded images up to this size in MB (default: 0, no cache)')
+    parser.add_argument('--cacheDir', default = os.path.join(os.path.expanduser('~'), '.cache', 'scrivx2pltr'), help = 'Where to keep cached data between runs (empty to disable)')
+    args = parser.parse_args()
+
+    # sanity check Scrivener file
+    if args.scrivfile[-1] == '/':
+        args.scrivfile = args.scrivfile[:-1]
+    if not os.path.isdir(args.scrivfile):
+        print("ERROR: Scrivener file " + args.scrivfile + " does not exist.")
+        exit(2)
+
+    # name of the .scrivx file may differ from the .scriv
+    scrivx = ''
+    with os.scandir(args.scrivfile) as it:
+        for entry in it:
+            if entry.name.endswith('.scrivx'):
+                scrivx = entry.name
+                break
+    if len(scrivx) == 0: # last-ditch effort ...
+        scrivx = os.path.basename(args.scrivfile) + 'x'
+
+    scrivxfile = os.path.join(args.scrivfile, scrivx)
+    if not os.path.isfile(scrivxfile):
+        print("ERROR: This does not appear to be a Scrivener file.")
+        exit(3)
+
+    if args.output:
+        if os.path.isdir(args.output):
+            p = scrivx.replace('.scrivx', '.pltr')
+            plottrfile = os.path.join(args.output, p)
+        else:
+            plottrfile = args.output
+    else:
+        # if not given, create from Scrivener file name
+        p = scrivx.replace('.scrivx', '.pltr')
+        plottrfile = os.path.join(os.path.dirname(args.scrivfile), p)
+
+    with open(scrivxfile, 'r', encoding = 'utf-8') as fs:
+        sx = fs.read()
 
-plottr.useLabelColors(args.useLabelColors)
-plottr.labelsAreCharacters(args.labelsAreCharacters)
-plottr.keywordsAreCharacters(args.keywordsAreCharacters)
-plottr.keywordsAreTags(args.keywordsAreTags)
+    scrivp = ET.fromstring(sx)
 
-# find the Manuscript folder, aka DraftFolder
-for item in scrivp.findall('.//BinderItem'):
-    if item.attrib['Type'] == 'DraftFolder':
-        manuscript = item
-        break
+    # final Scrivener sanity check: is it a Scrivener 3 file (XML version 2.0)?
+    if scrivp.attrib['Version'] != '2.0':
+        print("ERROR: This does not appear to be a Scrivener 3 file.")
+        exit(4)
 
-read_labels(scrivp)
-read_keywords(scrivp)
-read_characters(args.scrivfile, scrivp)
-read_places(args.scrivfile, scrivp)
-read_bookinfo(args.scrivfile)
+    # all fine, let's go
 
-for item in manuscript.find('Children'):
-    parse_binderitem(item)
+    plottr = PlottrContent()
 
-plottr.write(plottrfile)
+    plottr.useLabelColors(args.useLabelColors)
+    plottr.labelsAreCharacters(args.labelsAreCharacters)
+    plottr.keywordsAreCharacters(args.keywordsAreCharacters)
+    plottr.keywordsAreTags(args.keywordsAreTags)
+    plottr.estimateOnly(args.estimate)
+    imagecache = None
+    if len(args.cacheDir) > 0 and args.imageCacheSize > 0:
+        imagecache = ImageCache(os.path.join(args.cacheDir, 'images'), args.imageCacheSize * 1024 * 1024)
+        plottr.useImageCache(imagecache)
 
+    # find the Manuscript folder, aka DraftFolder
+    for item in scrivp.findall('.//BinderItem'):
+        if item.attrib['Type'] == 'DraftFolder':
+            manuscript = item
+            break
+
+    read_labels(scrivp)
+    read_keywords(scrivp)
+    read_characters(args.scrivfile, scrivp)
+    read_places(args.scrivfile, scrivp)
+    if imagecache is not None:
+        imagecache.flush()
+    read_bookinfo(args.scrivfile)
+
+    wordcounts = {}
+    if args.wordCounts:
+        plottr.addSceneAttribute('Word Count')
+    if args.wordCounts and not args.estimate:
+        uuids = [ item.attrib['UUID'] for item in manuscript.iter('BinderItem') if item is not manuscript and is_scene(item) ]
+        wordcounts = read_wordcounts(args.scrivfile, uuids)
+
+    # remember which cards came from which top-level item, for --shardByFolder
+    shards = []
+    for item in manuscript.find('Children'):
+        first = plottr.numCards() + 1
+        parse_binderitem(item)
+        last = plottr.numCards()
+
+        if last >= first:
+            if item.find('Children') is not None:
+                title = ''
+                child = item.find('Title')
+                if child is not None and child.text is not None:
+                    title = child.text
+                shards.append([ first, last, title, False ])
+            elif len(shards) > 0 and shards[-1][3] and shards[-1][1] == first - 1:
+                # loose scenes between folders go together
+                shards[-1][1] = last
+            else:
+                shards.append([ first, last, '', True ])
+
+    if args.shardSize > 0:
+        shards = []
+        for first in range(1, plottr.numCards() + 1, args.shardSize):
+            shards.append([ first, min(first + args.shardSize - 1, plottr.numCards()), '' ])
+
+    if args.estimate:
+        plottr.estimate(plottrfile)
+    elif (args.shardByFolder or args.shardSize > 0) and len(shards) > 1:
+        for n, sh in enumerate(shards):
+            if len(sh[2]) > 0:
+                sh[2] = plottr.booktitle + ' - ' + sh[2]
+            else:
+                sh[2] = plottr.booktitle + ' (' + str(n + 1) + ')'
+        write_shards(plottrfile, [ sh[:3] for sh in shards ])
+    else:
+        plottr.write(plottrfile)